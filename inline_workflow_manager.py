@@ -1,24 +1,378 @@
 # module.py - Streamlined Interface
+#
+# Logging: this module only creates its own named logger. Configuring handlers,
+# levels and formats (e.g. via logging.basicConfig) is the application's
+# responsibility — see main.py.
 
+import html
 import json
+import mmap
+import os
+import sys
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import logging
 from collections import defaultdict
-from telegram.helpers import escape_markdown # Import escaping utility
+from functools import lru_cache
+from types import MappingProxyType
+
+# Prefer orjson (C-accelerated) for parsing/serializing workflow JSON; fall back
+# to the stdlib json module if it is not installed.
+try:
+    import orjson
+
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    orjson = None
+
+    def _json_loads(data):
+        return json.loads(data)
+
+    def _json_dumps(obj):
+        return json.dumps(obj, indent=2)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Emojis
-RADIO_UNSELECTED = "🔘"
-RADIO_SELECTED = "🟢"
-CHECKBOX_UNSELECTED = "⬜"
-CHECKBOX_SELECTED = "✅"
-TOGGLE_OFF = "🔴"
-TOGGLE_ON = "🟢"
-BACK_EMOJI = "⬅️"
-DONE_EMOJI = "✅" # Or "▶️" "➡️" for next
+# Emojis, interned so identity checks short-circuit and the precomputed button
+# labels built from them share backing storage.
+RADIO_UNSELECTED = sys.intern("🔘")
+RADIO_SELECTED = sys.intern("🟢")
+CHECKBOX_UNSELECTED = sys.intern("⬜")
+CHECKBOX_SELECTED = sys.intern("✅")
+TOGGLE_OFF = sys.intern("🔴")
+TOGGLE_ON = sys.intern("🟢")
+BACK_EMOJI = sys.intern("⬅️")
+DONE_EMOJI = sys.intern("✅") # Or "▶️" "➡️" for next
+
+@lru_cache(maxsize=256)
+def _esc(text):
+    """Memoized HTML escaping for strings that recur (step descriptions,
+    fixed messages). html.escape is C-implemented and only touches &, < and >,
+    so this is mostly about deduplicating repeated inputs."""
+    return html.escape(text)
+
+
+# Static user-facing messages, escaped for HTML parse mode once at import
+# time; re-escaping these constants on every callback would be wasted work.
+_ESC_INIT_FAILED = html.escape("Workflow manager failed to initialize. Please contact support.")
+_ESC_NOT_INIT = html.escape("Workflow manager not initialized. Cannot process click.")
+_ESC_STATE_LOST = html.escape("Your workflow state was lost. Please start again with /start.")
+_ESC_BAD_DATA = html.escape("An internal error occurred (invalid button data).")
+_ESC_STEP_CFG_MISSING = html.escape("An internal error occurred (step config missing for current step).")
+_ESC_VALIDATION_ERR = html.escape("⚠️ Please make all required selections before proceeding.")
+_ESC_SUMMARY_INTRO = html.escape("Workflow completed! Here are your selections:")
+_ESC_NEXT_UI_ERR = html.escape("An error occurred generating the next step's UI.")
+_ESC_INTERNAL_ERR = html.escape("An internal error occurred while processing your request.")
+
+# Small-int type ids for the render hot loop: comparing ints is cheaper than
+# the repeated string compares on button_type, and keeps the per-button branch
+# data packed in the compiled button struct.
+_TYPE_PLAIN = 0
+_TYPE_RADIO = 1
+_TYPE_CHECKBOX = 2
+_TYPE_TOGGLE = 3
+_TYPE_IDS = {'radio': _TYPE_RADIO, 'checkbox': _TYPE_CHECKBOX, 'toggle': _TYPE_TOGGLE}
+
+# Sentinel response for stale/duplicate callbacks (e.g. a click on a step the
+# user is no longer on). The message Telegram is already showing is correct, so
+# callers should just answer the callback query and skip editMessageText
+# entirely instead of rebuilding an identical keyboard.
+_NO_CHANGE = (None, None, False)
+
+
+class _CachedMarkup(InlineKeyboardMarkup):
+    """
+    An InlineKeyboardMarkup that memoizes its serialized forms.
+
+    PTB re-runs to_dict()/to_json() every time a markup is posted to the Bot
+    API; for the prebuilt markups shared across users the payload never
+    changes, so serializing it once is enough. object.__setattr__ is needed
+    because TelegramObject instances are frozen after __init__.
+    """
+    __slots__ = ('_dict_cache', '_json_cache')
+
+    def __init__(self, inline_keyboard):
+        super().__init__(inline_keyboard)
+        object.__setattr__(self, '_dict_cache', None)
+        object.__setattr__(self, '_json_cache', None)
+
+    def to_dict(self, recursive=True):
+        if self._dict_cache is None:
+            object.__setattr__(self, '_dict_cache', super().to_dict(recursive))
+        return self._dict_cache
+
+    def to_json(self):
+        if self._json_cache is None:
+            object.__setattr__(self, '_json_cache', super().to_json())
+        return self._json_cache
+
+
+class CompiledButton:
+    """
+    A single button pre-compiled at init time.
+
+    Stores the emoji-prefixed label variants (selected/unselected, on/off) and
+    the callback_data string, so rendering a keyboard never formats strings —
+    it just picks one of two precomputed labels per button.
+    """
+    __slots__ = ('button_name', 'button_type', 'type_id', 'value', 'radio_group', 'initial_state',
+                 'skip_steps', 'callback_data', 'label_plain', 'label_selected', 'label_unselected',
+                 'ikb_plain', 'ikb_selected', 'ikb_unselected')
+
+    def __init__(self, button_config, callback_data):
+        # Intern the strings that participate in per-click dict lookups and
+        # comparisons, so those can short-circuit on pointer equality.
+        self.button_name = sys.intern(button_config['buttonName'])
+        self.button_type = button_config.get('type') # Default is None
+        # Small-int id for the render loop; 'skip', 'finish' and default buttons
+        # all render plain.
+        self.type_id = _TYPE_IDS.get(self.button_type, _TYPE_PLAIN)
+        value = button_config.get('value')
+        self.value = sys.intern(value) if isinstance(value, str) else value
+        radio_group = button_config.get('radioGroup')
+        self.radio_group = sys.intern(radio_group) if isinstance(radio_group, str) else radio_group
+        self.initial_state = button_config.get('initialState', False)
+        self.skip_steps = button_config.get('skipSteps', 0)
+        self.callback_data = callback_data
+
+        name = self.button_name
+        self.label_plain = name
+        if self.button_type == 'radio':
+            self.label_selected = f"{RADIO_SELECTED} {name}"
+            self.label_unselected = f"{RADIO_UNSELECTED} {name}"
+        elif self.button_type == 'checkbox':
+            self.label_selected = f"{CHECKBOX_SELECTED} {name}"
+            self.label_unselected = f"{CHECKBOX_UNSELECTED} {name}"
+        elif self.button_type == 'toggle':
+            # 'selected' doubles as the on state for toggles
+            self.label_selected = f"{TOGGLE_ON} {name}"
+            self.label_unselected = f"{TOGGLE_OFF} {name}"
+        else:
+            # 'skip', 'finish' and default buttons carry no state emoji
+            self.label_selected = name
+            self.label_unselected = name
+
+        # InlineKeyboardButton is immutable, so one instance per label variant
+        # can be shared across all renders, users and messages.
+        self.ikb_plain = InlineKeyboardButton(self.label_plain, callback_data=callback_data)
+        if self.label_selected is name and self.label_unselected is name:
+            self.ikb_selected = self.ikb_plain
+            self.ikb_unselected = self.ikb_plain
+        else:
+            self.ikb_selected = InlineKeyboardButton(self.label_selected, callback_data=callback_data)
+            self.ikb_unselected = InlineKeyboardButton(self.label_unselected, callback_data=callback_data)
+
+
+class CompiledStep:
+    """
+    Per-step configuration pre-extracted from the workflow JSON at init time.
+
+    The click/render hot paths read plain attributes from this struct instead
+    of chaining dict.get() calls with defaults on the raw JSON dicts.
+    """
+    __slots__ = ('options', 'button_rows', 'description', 'completion_type', 'back_button',
+                 'row_count', 'radio_groups', 'radio_button_values_by_group', 'radio_defaults',
+                 'done_callback_data', 'back_callback_data', 'escaped_description', 'state_factory',
+                 'done_row', 'back_row')
+
+    def __init__(self, step_key, step_config, step_index, buttons_by_id):
+        # Interned so the stale-click comparison against the user's current
+        # step is usually a pointer compare.
+        step_key = sys.intern(step_key)
+        # Navigation callback strings are static per step; the step index
+        # keeps them a handful of bytes ("d3"/"b3") instead of embedding the
+        # step key.
+        self.done_callback_data = f"d{step_index}"
+        self.back_callback_data = f"b{step_index}"
+        self.options = step_config.get('options', [])
+        self.description = step_config.get('description', 'Please make a selection:')
+        # Descriptions are static, so the HTML escaping only needs to run once
+        # per step, not on every render; _esc also dedups work for
+        # descriptions shared between steps (or across reloaded managers).
+        self.escaped_description = _esc(self.description)
+        self.completion_type = step_config.get('completionType', 'auto')
+        self.back_button = step_config.get('backButton')
+        self.row_count = len(self.options)
+
+        # Compile every button with its label variants and a compact integer
+        # callback id (its index in the manager-wide buttons_by_id table).
+        button_rows = []
+        for row in self.options:
+            button_row = []
+            for button_config in row:
+                button = CompiledButton(button_config, str(len(buttons_by_id)))
+                buttons_by_id.append((step_key, button))
+                button_row.append(button)
+            button_rows.append(tuple(button_row))
+        self.button_rows = tuple(button_rows)
+
+        # Collect radio groups (and their button values) declared in this step.
+        # Group names are interned so the per-click dict lookups keyed on them
+        # can short-circuit on pointer equality.
+        radio_values = {}
+        for row in self.options:
+            for button_config in row:
+                if button_config.get('type') == 'radio' and 'radioGroup' in button_config:
+                    group = sys.intern(button_config['radioGroup'])
+                    radio_values.setdefault(group, []).append(button_config.get('value'))
+        # A frozenset enables C-level set arithmetic against selection dict keys
+        # in _validate_manual_step_completion.
+        self.radio_groups = frozenset(radio_values)
+        self.radio_button_values_by_group = {group: tuple(values) for group, values in radio_values.items()}
+        # Default (first-declared) button value per group, used for pre-selection
+        # on manual radio steps. These never change, so computing them per render
+        # would be wasted work.
+        self.radio_defaults = {group: values[0] for group, values in radio_values.items()}
+
+        # Invariant container shape for this step's selection state, resolved
+        # once here instead of isinstance-checking per button per render:
+        # radio/toggle steps store a dict ({group_or_value: state}), checkbox
+        # steps store a set of values (O(1) membership in the render loop),
+        # stateless steps store the bare value.
+        # A step's stateful buttons must share one shape (checkbox buttons
+        # cannot be mixed with radio/toggle in the same step).
+        type_ids = {button.type_id for row in self.button_rows for button in row}
+        if _TYPE_RADIO in type_ids or _TYPE_TOGGLE in type_ids:
+            self.state_factory = dict
+        elif _TYPE_CHECKBOX in type_ids:
+            self.state_factory = set
+        else:
+            self.state_factory = None
+
+        # Navigation rows never vary, so the InlineKeyboardButton instances
+        # (immutable, shareable) are built once per step. Whether a previous
+        # step exists is also known here (step_index > 0), so the back row is
+        # resolved at compile time rather than re-checked per render.
+        self.done_row = ((InlineKeyboardButton(f"{DONE_EMOJI} Done / Next", callback_data=self.done_callback_data),)
+                         if self.completion_type == 'manual' else None)
+        if self.back_button and step_index == 0:
+            logger.debug("Step '%s' has backButton config but is the first step. Back button disabled.", step_key)
+        self.back_row = ((InlineKeyboardButton(f"{BACK_EMOJI} Go Back", callback_data=self.back_callback_data),)
+                         if self.back_button and step_index > 0 else None)
+
+
+class WorkflowState:
+    """
+    Per-user workflow state stored in context.user_data.
+
+    A slotted class instead of the old nested {'current_step': ..., 'selections':
+    {...}} dict: attribute access is faster than dict indexing, and the fixed
+    shape removes the per-click existence/isinstance validation of the layout.
+    """
+    __slots__ = ('current_step', 'selections')
+
+    def __init__(self, current_step=None, selections=None):
+        self.current_step = current_step
+        self.selections = selections if selections is not None else {}
+
+    def to_dict(self):
+        """Returns a plain-dict view for logging/serialization boundaries."""
+        return {'current_step': self.current_step, 'selections': self.selections}
+
+
+# Button types the dispatch and render paths know how to handle ('skip' and
+# 'finish' render plain but have their own click handlers).
+_KNOWN_BUTTON_TYPES = frozenset({'radio', 'checkbox', 'toggle', 'skip', 'finish'})
+
+
+def _validate_steps(workflow_steps):
+    """
+    Validates the raw step dicts before compilation and returns a list of
+    human-readable error strings (empty when the config is well-formed).
+    """
+    errors = []
+    for step_key, step_config in workflow_steps.items():
+        if not isinstance(step_config, dict):
+            errors.append(f"Step '{step_key}' must be an object, got {type(step_config).__name__}.")
+            continue
+
+        completion_type = step_config.get('completionType', 'auto')
+        if completion_type not in ('auto', 'manual'):
+            errors.append(f"Step '{step_key}': unknown completionType '{completion_type}'.")
+
+        options = step_config.get('options', [])
+        if not isinstance(options, list) or any(not isinstance(row, list) for row in options):
+            errors.append(f"Step '{step_key}': 'options' must be a list of button rows.")
+            continue
+
+        button_types = set()
+        for row in options:
+            for button_config in row:
+                if not isinstance(button_config, dict) or 'buttonName' not in button_config:
+                    errors.append(f"Step '{step_key}': every button needs a 'buttonName'.")
+                    continue
+                button_name = button_config['buttonName']
+                button_type = button_config.get('type')
+                button_types.add(button_type)
+                if button_type is not None and button_type not in _KNOWN_BUTTON_TYPES:
+                    errors.append(f"Step '{step_key}': button '{button_name}' has unknown type '{button_type}'.")
+                if button_type == 'radio' and not button_config.get('radioGroup'):
+                    errors.append(f"Step '{step_key}': radio button '{button_name}' is missing 'radioGroup'.")
+                if not isinstance(button_config.get('skipSteps', 0), int):
+                    errors.append(f"Step '{step_key}': button '{button_name}' has a non-integer 'skipSteps'.")
+
+        # A step's stateful buttons must share one selection-container shape
+        # (see CompiledStep.state_factory): checkbox steps store a set while
+        # radio/toggle steps store a dict, so mixing them would crash the
+        # per-click state updates.
+        if 'checkbox' in button_types and ('radio' in button_types or 'toggle' in button_types):
+            errors.append(f"Step '{step_key}': checkbox buttons cannot be mixed with radio/toggle buttons in the same step.")
+    return errors
+
+
+def _format_selection_value(value):
+    """Formats one step's selection (bare value, {group: value} dict, or list
+    of checkbox values) as a short human-readable string."""
+    if isinstance(value, dict):
+        return ', '.join(f"{k}={v}" for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return ', '.join(str(v) for v in value)
+    return str(value)
+
+
+@lru_cache(maxsize=32)
+def _cached_load(filepath, mtime):
+    """
+    Parses a workflow JSON file, caching the result per (filepath, mtime).
+
+    Repeated construction of managers for the same (unmodified) file becomes a
+    dict lookup instead of disk I/O plus a JSON parse. The result is wrapped in
+    a read-only MappingProxyType since it is shared across instances.
+
+    With orjson available the file is parsed straight out of an mmap'ed
+    buffer, skipping the intermediate bytes copy f.read() would allocate
+    (only worth anything for large workflow files, but free otherwise).
+    """
+    with open(filepath, 'rb') as f:
+        if orjson is not None:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and mmap-less filesystems fall back to a plain
+                # read. Only mapping construction is guarded here: decode
+                # errors from the parse below must propagate as ValueError so
+                # callers report them as such.
+                data = _json_loads(f.read())
+            else:
+                try:
+                    # Release the view before closing the map even when the
+                    # parse raises, else mm.close() raises BufferError over
+                    # the exported buffer.
+                    view = memoryview(mm)
+                    try:
+                        data = _json_loads(view)
+                    finally:
+                        view.release()
+                finally:
+                    mm.close()
+        else:
+            # stdlib json.loads does not accept buffer objects
+            data = _json_loads(f.read())
+    logger.info(f"Successfully loaded workflow data from {filepath}")
+    return MappingProxyType(data)
 
 
 class InlineWorkflowManager:
@@ -28,8 +382,21 @@ class InlineWorkflowManager:
     Handles stateful buttons (radio, checkbox, toggle) and navigation (forward, back, skip, manual completion, finish).
     Stores user state in context.user_data under a workflow-specific key.
     Implements radio button group validation and pre-selection for manual steps.
-    Handles MarkdownV2 escaping for dynamic text.
+    Handles HTML escaping for dynamic text (messages are sent with parse_mode='HTML').
+
+    All compiled structures (steps, button tables, prebuilt markups) are
+    immutable after __init__ and workflow_steps is a read-only mapping proxy,
+    so instances are safe to share across threads for read/render operations;
+    per-user mutable state lives only in context.user_data.
     """
+    # Fixed attribute set: avoids a per-instance __dict__ and makes attribute
+    # loads in the hot paths slightly cheaper. WorkflowState, CompiledStep and
+    # CompiledButton are slotted for the same reason.
+    __slots__ = ('workflow_filepath', 'workflow_name', 'workflow_steps', 'is_initialized',
+                 '_prefix_handlers', '_button_type_handlers', '_step_keys', '_step_index',
+                 '_num_steps', '_prev_step', '_compiled_steps', '_buttons_by_id',
+                 '_static_markups', '_build_stateful_markup')
+
     # Key under which workflow state is stored in context.user_data
     STATE_KEY = "_workflow_state"
 
@@ -41,50 +408,129 @@ class InlineWorkflowManager:
             workflow_filepath (str): The path to the workflow JSON file.
         """
         self.workflow_filepath = workflow_filepath
+
+        # Dispatch tables for the callback hot path: prefix -> handler for
+        # navigation/completion actions, button type -> handler for option
+        # buttons. Bound methods are resolved once here instead of walking an
+        # if/elif chain per click.
+        self._prefix_handlers = {
+            'b': self._handle_back,
+            'd': self._handle_done,
+        }
+        self._button_type_handlers = {
+            'finish': self._handle_finish_button,
+            'skip': self._handle_skip_button,
+            'radio': self._handle_stateful_button,
+            'checkbox': self._handle_stateful_button,
+            'toggle': self._handle_stateful_button,
+        }
+        # Per-instance memo of assembled keyboards for stateful steps, keyed
+        # by (step_key, canonicalized selection); identical selection states
+        # across users share one markup (and its cached serialization).
+        self._build_stateful_markup = lru_cache(maxsize=1024)(self._build_markup_for_selection)
+
         workflow_data = self._load_workflow_data(workflow_filepath)
         if not workflow_data:
              logger.error("Failed to load workflow data during initialization.")
              # In a real app, you might raise an exception here or have a fallback workflow
-             self.workflow_name = None
-             self.workflow_steps = {}
-             self._step_keys = []
-             self._radio_groups_per_step = {} # Ensure this is initialized even on failure
-             self.is_initialized = False
+             self._mark_uninitialized()
              return
 
         if len(workflow_data) != 1:
              logger.warning("Workflow data contains multiple top-level keys. Using the first one found.")
 
         self.workflow_name = list(workflow_data.keys())[0]
-        self.workflow_steps = workflow_data[self.workflow_name]
-        self._step_keys = list(self.workflow_steps.keys()) # Ordered list of step keys (Python 3.7+ guarantees order)
-
-        # Pre-calculate radio groups per step for faster validation/pre-selection
-        self._radio_groups_per_step = {}
-        for step_key, step_config in self.workflow_steps.items():
-            radio_groups = set()
-            for row in step_config.get('options', []):
-                for button_config in row:
-                    if button_config.get('type') == 'radio' and 'radioGroup' in button_config:
-                        radio_groups.add(button_config['radioGroup'])
-            if radio_groups:
-                self._radio_groups_per_step[step_key] = list(radio_groups) # Store as list
+        # Read-only view: nothing mutates the step dicts after __init__, and
+        # the proxy makes accidental writes fail loudly. The underlying data is
+        # shared across manager instances via _cached_load.
+        self.workflow_steps = MappingProxyType(workflow_data[self.workflow_name])
+
+        # Surface config mistakes at startup instead of as per-click surprises
+        # (the hot paths assume the compiled shapes are well-formed).
+        config_errors = _validate_steps(self.workflow_steps)
+        if config_errors:
+             for error in config_errors:
+                  logger.error("Workflow config error: %s", error)
+             self._mark_uninitialized()
+             return
+
+        # Ordered step keys (Python 3.7+ guarantees dict order), interned so
+        # equality checks against parsed callback data are mostly pointer
+        # compares; a tuple since the sequence never changes after init.
+        self._step_keys = tuple(sys.intern(k) for k in self.workflow_steps.keys())
+        self._step_index = {k: i for i, k in enumerate(self._step_keys)} # O(1) key -> position lookups
+        self._num_steps = len(self._step_keys)
+        # Direct step -> previous step map (None for the first step), so back
+        # navigation is a single dict lookup with no index arithmetic.
+        self._prev_step = {k: (self._step_keys[i - 1] if i > 0 else None)
+                           for i, k in enumerate(self._step_keys)}
+
+        # Pre-compile each step once so the per-click paths read plain attributes
+        # (options, completion type, radio groups) instead of dict.get chains.
+        # Buttons get flat integer callback ids assigned in declaration order;
+        # _buttons_by_id maps id -> (step_key, CompiledButton) for dispatch.
+        self._buttons_by_id = []
+        self._compiled_steps = {}
+        for step_index, (step_key, step_config) in enumerate(self.workflow_steps.items()):
+            self._compiled_steps[sys.intern(step_key)] = CompiledStep(
+                step_key, step_config, step_index, self._buttons_by_id)
+
+        # Telegram rejects callback_data longer than 64 bytes. The compact
+        # integer ids make an overrun practically impossible (it would take a
+        # ~10^62-button workflow), but the invariant is load-bearing for every
+        # click, so assert it once at startup instead of trusting it.
+        all_callback_data = [button.callback_data for _, button in self._buttons_by_id]
+        for compiled in self._compiled_steps.values():
+            all_callback_data.append(compiled.done_callback_data)
+            all_callback_data.append(compiled.back_callback_data)
+        oversized = [cbd for cbd in all_callback_data if len(cbd.encode('utf-8')) > 64]
+        if oversized:
+            logger.error("Workflow config error: callback_data exceeds Telegram's 64-byte limit: %s", oversized)
+            self._mark_uninitialized()
+            return
+
+        # Steps without stateful buttons always render the same keyboard, so the
+        # whole InlineKeyboardMarkup (navigation rows included) can be built once
+        # and shared across users.
+        self._static_markups = {}
+        for step_key, compiled in self._compiled_steps.items():
+            if any(button.button_type in ('radio', 'checkbox', 'toggle')
+                   for row in compiled.button_rows for button in row):
+                continue
+            rows = [[button.ikb_plain for button in row] for row in compiled.button_rows]
+            if compiled.done_row is not None:
+                rows.append(compiled.done_row)
+            if compiled.back_row is not None:
+                rows.append(compiled.back_row)
+            self._static_markups[step_key] = _CachedMarkup(rows)
 
         self.is_initialized = True
         logger.info(f"WorkflowManager initialized for workflow: '{self.workflow_name}' from '{workflow_filepath}' with steps: {self._step_keys}")
 
 
+    def _mark_uninitialized(self):
+        """Puts the manager in a safe empty state after a load/config failure."""
+        self.workflow_name = None
+        self.workflow_steps = {}
+        self._step_keys = ()
+        self._step_index = {}
+        self._num_steps = 0
+        self._prev_step = {}
+        self._compiled_steps = {}
+        self._buttons_by_id = []
+        self._static_markups = {}
+        self.is_initialized = False
+
     def _load_workflow_data(self, filepath):
-        """Loads workflow data from a JSON file."""
+        """Loads workflow data from a JSON file, reusing the cache when possible."""
         try:
-            with open(filepath, 'r') as f:
-                data = json.load(f)
-                logger.info(f"Successfully loaded workflow data from {filepath}")
-                return data
+            # Key the cache on the file's mtime so edits to the JSON invalidate it.
+            mtime = os.path.getmtime(filepath)
+            return _cached_load(filepath, mtime)
         except FileNotFoundError:
             logger.error(f"Workflow file not found: {filepath}")
             return None
-        except json.JSONDecodeError as e:
+        except ValueError as e: # orjson.JSONDecodeError and json.JSONDecodeError both subclass ValueError
             logger.error(f"Error decoding JSON from {filepath}: {e}")
             return None
         except Exception as e:
@@ -94,8 +540,8 @@ class InlineWorkflowManager:
     # --- Internal State & Navigation Helpers ---
 
     def _get_step_config(self, step_key):
-        """Retrieves the configuration for a given step key."""
-        return self.workflow_steps.get(step_key)
+        """Retrieves the compiled configuration for a given step key."""
+        return self._compiled_steps.get(step_key)
 
     def _get_initial_step_key(self):
         """Returns the key for the first step in the workflow."""
@@ -105,29 +551,21 @@ class InlineWorkflowManager:
 
     def _get_next_step_key(self, current_step_key, skip_steps=0):
         """Calculates the next step key after the current one, considering skips."""
-        try:
-            current_index = self._step_keys.index(current_step_key)
-            next_index = current_index + 1 + skip_steps
-            if 0 <= next_index < len(self._step_keys):
-                return self._step_keys[next_index]
-            else:
-                return None # Indicates end of workflow
-        except ValueError:
-            logger.error(f"Current step key '{current_step_key}' not found in workflow keys.")
+        current_index = self._step_index.get(current_step_key)
+        if current_index is None:
+            logger.error("Current step key '%s' not found in workflow keys.", current_step_key)
             return None
+        next_index = current_index + 1 + skip_steps
+        if 0 <= next_index < self._num_steps:
+            return self._step_keys[next_index]
+        return None # Indicates end of workflow
 
     def _get_previous_step_key(self, current_step_key):
-         """Calculates the previous step key."""
-         try:
-             current_index = self._step_keys.index(current_step_key)
-             prev_index = current_index - 1
-             if prev_index >= 0:
-                 return self._step_keys[prev_index]
-             else:
-                 return None # Indicates no previous step (start of workflow)
-         except ValueError:
-             logger.error(f"Current step key '{current_step_key}' not found in workflow keys.")
-             return None
+         """Returns the precomputed previous step key (None for the first step)."""
+         prev_step_key = self._prev_step.get(current_step_key)
+         if prev_step_key is None and current_step_key not in self._prev_step:
+             logger.error("Current step key '%s' not found in workflow keys.", current_step_key)
+         return prev_step_key
 
     # --- User State Management in context.user_data ---
 
@@ -136,124 +574,215 @@ class InlineWorkflowManager:
         # Check if initialized before accessing workflow_name
         if not self.is_initialized:
              logger.error("WorkflowManager not initialized successfully. Cannot get state from context.")
-             # Return a dummy structure to prevent immediate KeyError, but indicate issue
-             return {'current_step': None, 'selections': {}}
-
-        if self.workflow_name not in context.user_data:
-             context.user_data[self.workflow_name] = {
-                 'current_step': self._get_initial_step_key(), # Use internal method
-                 'selections': {}
-             }
-             logger.debug(f"Initialized workflow state in context.user_data['{self.workflow_name}']")
-
-        # Ensure 'selections' is a dict within the workflow state
-        workflow_state = context.user_data[self.workflow_name]
-        if 'selections' not in workflow_state or not isinstance(workflow_state['selections'], dict):
-             logger.warning(f"User data for workflow '{self.workflow_name}' corrupted. Resetting selections.")
-             workflow_state['selections'] = {}
-
+             # Return a dummy state to prevent immediate AttributeError, but indicate issue
+             return WorkflowState()
+
+        # Single-lookup fast path: state objects are only ever created here, so
+        # a non-None hit is guaranteed to be a well-formed WorkflowState and
+        # needs no shape validation. External code writing junk under our key
+        # will surface as an AttributeError rather than being silently reset.
+        user_data = context.user_data
+        workflow_state = user_data.get(self.workflow_name)
+        if workflow_state is None:
+             workflow_state = user_data[self.workflow_name] = WorkflowState(self._get_initial_step_key())
+             logger.debug("Initialized workflow state in context.user_data['%s']", self.workflow_name)
         return workflow_state
 
 
-    def _get_user_current_step_key(self, context):
+    def _get_user_current_step_key(self, context, workflow_state=None):
         """Gets the key of the user's current step from context."""
-        workflow_state = self._get_workflow_state_from_context(context)
-        return workflow_state.get('current_step')
+        if workflow_state is None:
+            workflow_state = self._get_workflow_state_from_context(context)
+        return workflow_state.current_step
 
-    def _set_user_step(self, context, step_key):
+    def _set_user_step(self, context, step_key, workflow_state=None):
         """Sets the user's current step in context."""
-        workflow_state = self._get_workflow_state_from_context(context)
-        workflow_state['current_step'] = step_key
-        logger.debug(f"User current step set to: {step_key}")
+        if workflow_state is None:
+            workflow_state = self._get_workflow_state_from_context(context)
+        workflow_state.current_step = step_key
+        logger.debug("User current step set to: %s", step_key)
 
-    def _get_selection_value(self, context, step_key):
+    def _get_selection_value(self, context, step_key, workflow_state=None):
         """Retrieves the recorded selection(s) for a specific step from context."""
-        workflow_state = self._get_workflow_state_from_context(context)
-        return workflow_state['selections'].get(step_key)
+        if workflow_state is None:
+            workflow_state = self._get_workflow_state_from_context(context)
+        return workflow_state.selections.get(step_key)
 
-    def _update_selection(self, context, step_key, button_config):
-        """Updates the user's selection for a step in context based on button type."""
-        workflow_state = self._get_workflow_state_from_context(context)
-        selection_value = button_config.get('value')
-        button_type = button_config.get('type')
-        radio_group = button_config.get('radioGroup')
+    def _update_selection(self, context, step_key, button, workflow_state=None):
+        """Updates the user's selection for a step in context based on button type.
+
+        `button` is a CompiledButton: all defaults were resolved at load time,
+        so this reads plain attributes instead of dict.get chains.
 
-        # Only update state for buttons that represent a selection
+        Returns True when the stored state actually changed. Re-clicking an
+        already-selected radio option is a no-op (checkbox/toggle always flip),
+        and callers use the False return to skip rebuilding and re-sending an
+        identical keyboard.
+        """
+        if workflow_state is None:
+            workflow_state = self._get_workflow_state_from_context(context)
+        selection_value = button.value
+        button_type = button.button_type
+        radio_group = button.radio_group
+
+        # Only update state for buttons that represent a selection. The
+        # container shape per step is invariant (dict for radio/toggle, set
+        # for checkbox — see CompiledStep.state_factory), so setdefault is
+        # enough to guarantee it exists; no isinstance re-checks needed.
         if button_type in [None, 'radio', 'checkbox', 'toggle', 'skip']: # Include skip as it has a value like 'any'
-             current_selection_state = workflow_state['selections'].get(step_key)
 
              if button_type is None or button_type == 'skip':
-                  workflow_state['selections'][step_key] = selection_value
-                  logger.debug(f"User: Selection button '{button_config.get('buttonName')}' ({button_type}) pressed. Value '{selection_value}' recorded for step '{step_key}'.")
+                  workflow_state.selections[step_key] = selection_value
+                  if logger.isEnabledFor(logging.DEBUG):
+                       logger.debug("User: Selection button '%s' (%s) pressed. Value '%s' recorded for step '%s'.", button.button_name, button_type, selection_value, step_key)
 
              elif button_type == 'radio':
-                  if not isinstance(current_selection_state, dict):
-                       current_selection_state = {}
-                       logger.debug(f"User: Initializing/resetting radio selection state for step '{step_key}'.")
-
                   if radio_group:
+                      current_selection_state = workflow_state.selections.setdefault(step_key, {})
+                      if current_selection_state.get(radio_group) == selection_value:
+                           logger.debug("User: Radio button '%s' re-clicked with unchanged value. No-op.", button.button_name)
+                           return False
                       current_selection_state[radio_group] = selection_value
-                      workflow_state['selections'][step_key] = current_selection_state
-                      logger.debug(f"User: Radio button '{button_config.get('buttonName')}' pressed. Group '{radio_group}' value '{selection_value}' recorded for step '{step_key}'.")
+                      if logger.isEnabledFor(logging.DEBUG):
+                           logger.debug("User: Radio button '%s' pressed. Group '%s' value '%s' recorded for step '%s'.", button.button_name, radio_group, selection_value, step_key)
                   else:
-                      logger.warning(f"User: Radio button '{button_config.get('buttonName')}' missing 'radioGroup'. Value '{selection_value}' ignored for state update.")
+                      logger.warning("User: Radio button '%s' missing 'radioGroup'. Value '%s' ignored for state update.", button.button_name, selection_value)
+                      return False
 
              elif button_type == 'checkbox':
-                 if not isinstance(current_selection_state, list):
-                      current_selection_state = []
-                      logger.warning(f"User: State for step '{step_key}' was not a list for checkbox. Resetting.")
+                 current_selection_state = workflow_state.selections.setdefault(step_key, set())
 
                  if selection_value in current_selection_state:
                      current_selection_state.remove(selection_value)
-                     logger.debug(f"User: Checkbox '{button_config.get('buttonName')}' deselected. Value '{selection_value}' removed from step '{step_key}'.")
+                     if logger.isEnabledFor(logging.DEBUG):
+                          logger.debug("User: Checkbox '%s' deselected. Value '%s' removed from step '%s'.", button.button_name, selection_value, step_key)
                  else:
-                     current_selection_state.append(selection_value)
-                     logger.debug(f"User: Checkbox '{button_config.get('buttonName')}' selected. Value '{selection_value}' added to step '{step_key}'.")
-
-                 workflow_state['selections'][step_key] = current_selection_state
+                     current_selection_state.add(selection_value)
+                     if logger.isEnabledFor(logging.DEBUG):
+                          logger.debug("User: Checkbox '%s' selected. Value '%s' added to step '%s'.", button.button_name, selection_value, step_key)
 
              elif button_type == 'toggle':
-                 if not isinstance(current_selection_state, dict):
-                      current_selection_state = {}
-
-                 current_state_for_value = current_selection_state.get(selection_value, button_config.get('initialState', False))
+                 current_selection_state = workflow_state.selections.setdefault(step_key, {})
+                 current_state_for_value = current_selection_state.get(selection_value, button.initial_state)
                  current_selection_state[selection_value] = not current_state_for_value
-                 logger.debug(f"User: Toggle '{button_config.get('buttonName')}' flipped to {current_selection_state[selection_value]}.")
-                 workflow_state['selections'][step_key] = current_selection_state
+                 if logger.isEnabledFor(logging.DEBUG):
+                      logger.debug("User: Toggle '%s' flipped to %s.", button.button_name, current_selection_state[selection_value])
+
+             return True
 
-    def _validate_manual_step_completion(self, context, step_key):
+        return False
+
+    def _validate_manual_step_completion(self, context, step_key, workflow_state=None):
         """
         Validates if the required selections have been made for a manual completion step.
         Checks if at least one option is selected in each radio group for this step.
         Returns True if validation passes, False otherwise.
         """
         step_config = self._get_step_config(step_key)
-        if step_config.get('completionType') != 'manual':
+        if step_config.completion_type != 'manual':
              return True # Validation only applies to manual steps
 
-        required_radio_groups = self._radio_groups_per_step.get(step_key, [])
+        required_radio_groups = step_config.radio_groups
 
         # If no radio groups, consider valid *for radios*. Add other validation if needed.
         if not required_radio_groups:
              return True
 
-        user_selections = self._get_selection_value(context, step_key)
+        user_selections = self._get_selection_value(context, step_key, workflow_state)
 
-        # For radio groups, the selection state for the step should be a dictionary {group: value}
-        if not isinstance(user_selections, dict):
-             logger.debug(f"Step '{step_key}' requires radio selections but state is not a dict ({type(user_selections).__name__}).")
-             return False # Must be a dictionary to hold radio group selections state
+        # Radio steps always store a dict {group: value} (invariant container
+        # shape); None just means the step was never rendered/selected.
+        if user_selections is None:
+             logger.debug("Step '%s' requires radio selections but none were recorded.", step_key)
+             return False
 
-        # Check if a non-None selection exists for every required radio group
-        for group in required_radio_groups:
-             if group not in user_selections or user_selections.get(group) is None:
-                  logger.debug(f"Step '{step_key}' missing selection for radio group '{group}'. State: {user_selections}")
-                  return False # Missing a selection for a required group
+        # Check if a non-None selection exists for every required radio group.
+        # The set difference runs in C against the selection dict's key view.
+        missing = required_radio_groups - user_selections.keys()
+        if missing or any(user_selections[group] is None for group in required_radio_groups):
+             if logger.isEnabledFor(logging.DEBUG):
+                  logger.debug("Step '%s' missing selection for radio group(s). State: %s", step_key, user_selections)
+             return False # Missing a selection for a required group
 
-        logger.debug(f"Step '{step_key}' manual completion validation passed.")
+        logger.debug("Step '%s' manual completion validation passed.", step_key)
         return True
 
 
+    # --- Callback Handlers (dispatched from process_callback_and_get_response) ---
+    # Each handler returns (next_step_key_after_logic, is_workflow_end, message_override_text).
+    # A (None, False, None) result means the click was a no-op (state unchanged)
+    # and the caller should answer the query without editing the message.
+
+    def _handle_back(self, context, current_step_key, workflow_state=None):
+        """Handles the 'back' navigation action."""
+        previous_step_key = self._get_previous_step_key(current_step_key)
+        if previous_step_key:
+            self._set_user_step(context, previous_step_key, workflow_state)
+            logger.info("User: Navigated back to step '%s' from '%s'.", previous_step_key, current_step_key)
+            return previous_step_key, False, None
+        logger.info("User: Cannot go back from initial step '%s'. Staying put.", current_step_key)
+        return current_step_key, False, None
+
+    def _handle_done(self, context, current_step_key, workflow_state=None):
+        """Handles the 'done' completion action for manual steps."""
+        # Validate completion requirements for this manual step
+        if self._validate_manual_step_completion(context, current_step_key, workflow_state):
+            # Validation passed, move to the next step
+            next_step_key = self._get_next_step_key(current_step_key)
+            self._set_user_step(context, next_step_key, workflow_state)
+            if next_step_key is None:
+                logger.info("User: Workflow ended after completing step '%s'.", current_step_key)
+                return None, True, None
+            return next_step_key, False, None
+
+        # Validation failed, stay on the current step and show an error message
+        logger.info("User: Manual step '%s' completion validation failed.", current_step_key)
+        return current_step_key, False, _ESC_VALIDATION_ERR
+
+    def _handle_finish_button(self, context, current_step_key, button, workflow_state=None):
+        """A 'finish' button explicitly ends the workflow."""
+        self._update_selection(context, current_step_key, button, workflow_state) # Record value if any
+        return None, True, None
+
+    def _handle_skip_button(self, context, current_step_key, button, workflow_state=None):
+        """A 'skip' button records its value and navigates immediately, skipping steps."""
+        self._update_selection(context, current_step_key, button, workflow_state)
+        next_step_key = self._get_next_step_key(current_step_key, skip_steps=button.skip_steps)
+        self._set_user_step(context, next_step_key, workflow_state)
+        if next_step_key is None:
+            # Workflow ended due to skip going past the last step
+            logger.info("User: Workflow ended after a skip from step '%s'.", current_step_key)
+            return None, True, None
+        return next_step_key, False, None
+
+    def _handle_stateful_button(self, context, current_step_key, button, workflow_state=None):
+        """
+        Radio/checkbox/toggle buttons change state and stay on the SAME step
+        (navigation happens via the 'done' button in manual steps).
+        """
+        if not self._update_selection(context, current_step_key, button, workflow_state):
+            # No-op click (e.g. the already-selected radio option): the
+            # displayed keyboard is already correct, so skip the re-render.
+            return None, False, None
+        return current_step_key, False, None
+
+    def _handle_default_button(self, context, current_step_key, button, workflow_state=None):
+        """A default button (no type) records its value and auto-advances if the step allows it."""
+        self._update_selection(context, current_step_key, button, workflow_state)
+
+        if self._get_step_config(current_step_key).completion_type == 'auto':
+            next_step_key = self._get_next_step_key(current_step_key)
+            self._set_user_step(context, next_step_key, workflow_state)
+            if next_step_key is None:
+                # Workflow ended after auto-forward past last step
+                logger.info("User: Workflow ended after an auto-forward click from step '%s'.", current_step_key)
+                return None, True, None
+            return next_step_key, False, None
+
+        # Default button in a 'manual' step - stay put (should ideally not exist or be ignored)
+        logger.warning("User: Default button '%s' clicked in 'manual' step '%s'. Staying put.", button.button_name, current_step_key)
+        return current_step_key, False, None
+
     # --- Public Interface Methods ---
 
     def start_workflow(self, context):
@@ -267,7 +796,7 @@ class InlineWorkflowManager:
             tuple: (InlineKeyboardMarkup, str) or (None, str) if an error occurred.
         """
         if not self.is_initialized:
-             return None, escape_markdown("Workflow manager failed to initialize. Please contact support.", version=2)
+             return None, _ESC_INIT_FAILED
 
         self.reset_user_state(context)
         # generate_keyboard_and_text will get the initial step key from the newly reset state
@@ -285,169 +814,100 @@ class InlineWorkflowManager:
 
         Returns:
             tuple: (response_text, reply_markup, is_final_message)
-                   response_text: The text to display in the message (already MarkdownV2 escaped).
+                   response_text: The text to display in the message (already HTML escaped).
                    reply_markup: The InlineKeyboardMarkup to display (or None).
                    is_final_message: True if this response is the final message of the workflow.
+                   (None, None, False) signals a stale/duplicate click: the caller should
+                   just answer the callback query and leave the message untouched.
         """
         if not self.is_initialized:
-             return escape_markdown("Workflow manager not initialized. Cannot process click.", version=2), None, True # Treat as end state error
+             return _ESC_NOT_INIT, None, True # Treat as end state error
 
-        current_step_key = self._get_user_current_step_key(context)
+        # Fetch the per-user state once and thread it through the helpers below,
+        # instead of re-validating context.user_data on every internal call.
+        workflow_state = self._get_workflow_state_from_context(context)
+        current_step_key = workflow_state.current_step
 
         # --- Handle Critical Error: Missing current step key ---
         if not current_step_key:
-             logger.error(f"User state missing current_step_key in context.user_data['{self.workflow_name}'] for callback {callback_data}. Resetting state.")
+             logger.error("User state missing current_step_key in context.user_data['%s'] for callback %s. Resetting state.", self.workflow_name, callback_data)
              self.reset_user_state(context)
              # Return end state with escaped error message
-             return escape_markdown("Your workflow state was lost. Please start again with /start.", version=2), None, True
+             return _ESC_STATE_LOST, None, True
 
 
-        logger.debug(f"User: Processing callback_data: {callback_data} from step {current_step_key}")
+        logger.debug("User: Processing callback_data: %s from step %s", callback_data, current_step_key)
 
         message_override_text = None # Text to show instead of step description (e.g., validation error)
         is_workflow_end = False
         next_step_key_after_logic = current_step_key # Default to staying on the same step after logic
 
 
-        # --- Handle Navigation/Completion Actions First (Back, Done) ---
-
-        # Handle 'back' action
-        if callback_data.startswith("back:"):
-            back_from_step = callback_data.split(':')[1]
-            if back_from_step != current_step_key:
-                 logger.warning(f"User: 'Back' callback from step '{back_from_step}' received while on step '{current_step_key}'. Ignoring.")
-                 # Stay on current step if mismatch, but generate UI for current step
-                 return self._generate_keyboard_and_text(context) + (False,) # Append is_final_message=False
+        # --- Dispatch on the parsed action ---
+        # Callback data is compact: "<button_id>" (a flat integer index into
+        # _buttons_by_id) for option buttons, or "d<step_idx>" / "b<step_idx>"
+        # for done/back navigation. One int() plus a list index replaces the
+        # old "step_key:row:col" split, and keeps payloads well under
+        # Telegram's 64-byte limit regardless of step key length.
+        prefix_handler = self._prefix_handlers.get(callback_data[:1])
 
-            previous_step_key = self._get_previous_step_key(current_step_key)
-            if previous_step_key:
-                self._set_user_step(context, previous_step_key)
-                next_step_key_after_logic = previous_step_key # We are moving back to the previous step
-                logger.info(f"User: Navigated back to step '{previous_step_key}' from '{current_step_key}'.")
-            else:
-                logger.info(f"User: Cannot go back from initial step '{current_step_key}'. Staying put.")
-                next_step_key_after_logic = current_step_key # Stay on current step
-            # The UI for the step determined by next_step_key_after_logic will be generated below
-
-        # Handle 'done' action for manual steps
-        elif callback_data.startswith("done:"):
-            done_from_step = callback_data.split(':')[1]
-            if done_from_step != current_step_key:
-                 logger.warning(f"User: 'Done' callback from step '{done_from_step}' received while on step '{current_step_key}'. Ignoring.")
-                 # Stay on current step if mismatch
-                 return self._generate_keyboard_and_text(context) + (False,) # Append is_final_message=False
-
-            # Validate completion requirements for this manual step
-            if self._validate_manual_step_completion(context, current_step_key):
-                 # Validation passed, move to the next step
-                 next_step_key_actual = self._get_next_step_key(current_step_key)
-                 self._set_user_step(context, next_step_key_actual)
-                 next_step_key_after_logic = next_step_key_actual # Render the next step
-
-                 if next_step_key_after_logic is None:
-                     is_workflow_end = True
-                     logger.info(f"User: Workflow ended after completing step '{current_step_key}'.")
+        # Navigation/completion actions (back, done)
+        if prefix_handler is not None:
+            try:
+                step_idx = int(callback_data[1:])
+            except ValueError:
+                logger.error("Invalid navigation callback data: %s", callback_data)
+                return _ESC_BAD_DATA, self._generate_keyboard_and_text(context, workflow_state)[0], False
 
-            else:
-                 # Validation failed, stay on the current step and show an error message
-                 logger.info(f"User: Manual step '{current_step_key}' completion validation failed.")
-                 next_step_key_after_logic = current_step_key # Stay on the current step
-                 # Escape the error message for MarkdownV2 - done in _validate_manual_step_completion
-                 message_override_text = escape_markdown("⚠️ Please make all required selections before proceeding.", version=2)
+            if step_idx != self._step_index.get(current_step_key):
+                 logger.warning("User: Navigation callback for step index %s received while on step '%s'. Ignoring.", step_idx, current_step_key)
+                 # Stale click: the visible message is already correct, so skip the re-render
+                 return _NO_CHANGE
 
+            next_step_key_after_logic, is_workflow_end, message_override_text = prefix_handler(context, current_step_key, workflow_state)
 
         # --- Handle Option Button Clicks ---
-        # Parse callback data: "step_key:row_index:button_index"
         else: # It's a regular option button click
             try:
-                parts = callback_data.split(':')
-                if len(parts) != 3:
-                    logger.error(f"Invalid callback data format for option button: {callback_data}")
-                    # Return error message and stay on current step
-                    return escape_markdown("An internal error occurred (invalid button data).", version=2), self._generate_keyboard_and_text(context)[0], False
+                button_id = int(callback_data)
+                if not 0 <= button_id < len(self._buttons_by_id):
+                    logger.error("Callback button id out of range: %s", callback_data)
+                    return _ESC_BAD_DATA, self._generate_keyboard_and_text(context, workflow_state)[0], False
 
-                clicked_step_key = parts[0]
-                row_index = int(parts[1])
-                button_index = int(parts[2])
+                # All defaults were resolved at load time.
+                clicked_step_key, button = self._buttons_by_id[button_id]
 
                 # Ensure the callback is for the step the user is currently on
                 if clicked_step_key != current_step_key:
-                    logger.warning(f"User: Callback from step '{clicked_step_key}' received while user is on step '{current_step_key}'. Ignoring.")
-                    # Stay on current step if mismatch
-                    return self._generate_keyboard_and_text(context) + (False,) # Append is_final_message=False
-
-
-                step_config = self._get_step_config(current_step_key)
-                if not step_config:
-                     logger.error(f"Step config not found for key: {current_step_key}")
-                     self.reset_user_state(context) # Reset on critical config error
-                     # Return end state with error message
-                     return escape_markdown("An internal error occurred (step configuration missing). Please restart.", version=2), None, True
-
-                # Retrieve the button configuration using indices
-                row_config = step_config.get('options', [])[row_index]
-                button_config = row_config[button_index]
-
-                button_type = button_config.get('type') # Default is None
-                skip_steps = button_config.get('skipSteps', 0) # Default to 0 skip steps
-                step_completion_type = step_config.get('completionType', 'auto') # Default to auto
-
+                    logger.warning("User: Callback from step '%s' received while user is on step '%s'. Ignoring.", clicked_step_key, current_step_key)
+                    # Stale click: the visible message is already correct, so skip the re-render
+                    return _NO_CHANGE
 
                 # --- Update State & Determine Next Step ---
+                button_handler = self._button_type_handlers.get(button.button_type, self._handle_default_button)
+                next_step_key_after_logic, is_workflow_end, message_override_text = button_handler(context, current_step_key, button, workflow_state)
 
-                if button_type == 'finish':
-                    # This button explicitly ends the workflow
-                    self._update_selection(context, current_step_key, button_config) # Record value if any
-                    is_workflow_end = True
-                    next_step_key_after_logic = None # Signal workflow end
-
-                elif button_type == 'skip':
-                     # Record the value and navigate immediately
-                     self._update_selection(context, current_step_key, button_config)
-                     next_step_key_actual = self._get_next_step_key(current_step_key, skip_steps=skip_steps)
-                     self._set_user_step(context, next_step_key_actual)
-                     next_step_key_after_logic = next_step_key_actual # Render the step after skipping
-
-                     if next_step_key_after_logic is None:
-                         is_workflow_end = True # Workflow ended due to skip going past the last step
-                         logger.info(f"User: Workflow ended after a skip from step '{current_step_key}'.")
-
-                elif button_type in ['radio', 'checkbox', 'toggle']:
-                    # These buttons change state and typically stay on the SAME step
-                    # (navigation happens via 'done' button in manual steps)
-                    self._update_selection(context, current_step_key, button_config)
-                    next_step_key_after_logic = current_step_key # Stay on current step to show state change
-
-                else: # Default button (type is None)
-                    # Record value and navigate immediately if completionType is 'auto'
-                    self._update_selection(context, current_step_key, button_config)
-
-                    if step_completion_type == 'auto':
-                         next_step_key_actual = self._get_next_step_key(current_step_key)
-                         self._set_user_step(context, next_step_key_actual)
-                         next_step_key_after_logic = next_step_key_actual # Render the next step
-
-                         if next_step_key_after_logic is None:
-                            is_workflow_end = True # Workflow ended after auto-forward past last step
-                            logger.info(f"User: Workflow ended after an auto-forward click from step '{current_step_key}'.")
-                    else: # Default button in a 'manual' step - stay put (should ideally not exist or be ignored)
-                         logger.warning(f"User: Default button '{button_config.get('buttonName')}' clicked in 'manual' step '{current_step_key}'. Staying put.")
-                         next_step_key_after_logic = current_step_key # Stay on current step
-
-            except (IndexError, ValueError) as e:
-                logger.error(f"Error processing callback data '{callback_data}' for user: {e}", exc_info=True)
+            except ValueError as e:
+                logger.error("Error processing callback data '%s' for user: %s", callback_data, e, exc_info=True)
                 # Stay on current step on error and return an escaped error message
-                return escape_markdown("An internal error occurred while processing your request.", version=2), self._generate_keyboard_and_text(context)[0], False # Pass current keyboard
+                return _ESC_INTERNAL_ERR, self._generate_keyboard_and_text(context, workflow_state)[0], False # Pass current keyboard
 
         # --- Prepare Response UI based on Next Step / Workflow End ---
 
+        # No-op click (state unchanged, same step): the displayed message is
+        # already correct, so skip the keyboard rebuild and the edit entirely.
+        if next_step_key_after_logic is None and not is_workflow_end and message_override_text is None:
+            return _NO_CHANGE
+
         if is_workflow_end:
             # Workflow finished. Get final selections and prepare summary text.
             final_selections = self.get_user_selections(context)
-            # Escape the introductory text, JSON dump should be fine in ```json block
-            summary_intro_text = escape_markdown("Workflow completed! Here are your selections:", version=2)
-            selections_json_str = json.dumps(final_selections, indent=2)
-            response_text = f"{summary_intro_text}\n```json\n{selections_json_str}\n```"
+            # The JSON dump goes in a <pre> block and must itself be escaped.
+            # No selections is a common end case (e.g. finishing straight away) —
+            # skip the serializer entirely for it.
+            summary_intro_text = _ESC_SUMMARY_INTRO
+            selections_json_str = html.escape(_json_dumps(final_selections)) if final_selections else "{}"
+            response_text = f"{summary_intro_text}\n<pre>{selections_json_str}</pre>"
             reply_markup = None # No keyboard needed for the final message
 
             # Optionally reset state after showing summary
@@ -459,14 +919,14 @@ class InlineWorkflowManager:
             # (This should have been done above, but double check or rely on _get_workflow_state_from_context's current_step)
             # self._set_user_step(context, next_step_key_after_logic) # This might already be done
 
-            reply_markup, default_step_text = self._generate_keyboard_and_text(context) # text is already escaped description
+            reply_markup, default_step_text = self._generate_keyboard_and_text(context, workflow_state) # text is already escaped description
 
             # Use override text (like validation error) if it exists, otherwise use the default step text
             response_text = message_override_text if message_override_text is not None else default_step_text
 
             if not reply_markup and not response_text:
-                logger.error(f"generate_keyboard_and_text returned no UI for step '{next_step_key_after_logic}'. State: {self._get_workflow_state_from_context(context)}")
-                response_text = escape_markdown("An error occurred generating the next step's UI.", version=2)
+                logger.error("generate_keyboard_and_text returned no UI for step '%s'. State: %s", next_step_key_after_logic, workflow_state)
+                response_text = _ESC_NEXT_UI_ERR
                 reply_markup = None # Ensure no partial keyboard
                 # Consider if this should set is_workflow_end = True
 
@@ -475,158 +935,171 @@ class InlineWorkflowManager:
         return response_text, reply_markup, is_workflow_end
 
 
-    def _generate_keyboard_and_text(self, context):
+    def _generate_keyboard_and_text(self, context, workflow_state=None):
         """
         Generates the InlineKeyboardMarkup and message text for the user's *current* step
         (as stored in context.user_data). Includes emojis for stateful buttons and
-        navigation/completion buttons. Applies MarkdownV2 escaping to description text.
+        navigation/completion buttons. Applies HTML escaping to description text.
         This is an internal helper method.
 
         Args:
             context (ContextTypes.DEFAULT_TYPE): The context object.
+            workflow_state (dict, optional): The already-fetched per-user state;
+                looked up from context when not provided.
 
         Returns:
             tuple: (InlineKeyboardMarkup, str) or (None, str) if the step is not found or error.
                    The string is the escaped description.
         """
-        current_step_key = self._get_user_current_step_key(context)
+        if workflow_state is None:
+            workflow_state = self._get_workflow_state_from_context(context)
+        current_step_key = workflow_state.current_step
         step_config = self._get_step_config(current_step_key)
 
         if not step_config:
-            logger.error(f"Could not find configuration for current step in context: {current_step_key}.")
+            logger.error("Could not find configuration for current step in context: %s.", current_step_key)
             # Escape the error message
-            return None, escape_markdown("An internal error occurred (step config missing for current step).", version=2)
-
-        keyboard_rows = []
-        user_selections_for_step = self._get_selection_value(context, current_step_key)
-        step_completion_type = step_config.get('completionType', 'auto') # Default to auto
+            return None, _ESC_STEP_CFG_MISSING
+
+        # Fully static step: reuse the prebuilt shared markup
+        static_markup = self._static_markups.get(current_step_key)
+        if static_markup is not None:
+            return static_markup, step_config.escaped_description
+
+        step_completion_type = step_config.completion_type
+
+        # Stateful steps always use the same container shape (see
+        # CompiledStep.state_factory); allocate it up front so the render loop
+        # below can index/probe it directly without isinstance checks.
+        if step_config.state_factory is not None:
+            user_selections_for_step = workflow_state.selections.get(current_step_key)
+            if user_selections_for_step is None:
+                user_selections_for_step = workflow_state.selections[current_step_key] = step_config.state_factory()
+                logger.debug("User: Initialized %s selection state for step '%s'.", step_config.state_factory.__name__, current_step_key)
+        else:
+            user_selections_for_step = workflow_state.selections.get(current_step_key)
 
         # --- Radio Button Pre-selection (for manual steps with radios) ---
         # This ensures a radio button is visually selected and a default value is saved
         # if the user lands on a manual radio step and hasn't selected anything yet.
-        required_radio_groups = self._radio_groups_per_step.get(current_step_key, [])
+        required_radio_groups = step_config.radio_groups
         if step_completion_type == 'manual' and required_radio_groups:
-            # Ensure selection state for this step is a dictionary for radio groups
-            if not isinstance(user_selections_for_step, dict):
-                user_selections_for_step = {}
-                # Update state in context immediately
-                workflow_state = self._get_workflow_state_from_context(context)
-                workflow_state['selections'][current_step_key] = user_selections_for_step
-                logger.debug(f"User: Initializing selection state as dict for step '{current_step_key}' for radio pre-selection.")
-
-
-            initial_selection_made = False
-            temp_selections_update = user_selections_for_step.copy() # Work on a copy for pre-selection logic
-
-            for row in step_config.get('options', []):
-                 for button_config in row:
-                      # Only consider actual radio buttons for pre-selection
-                      if button_config.get('type') == 'radio' and 'radioGroup' in button_config:
-                           group = button_config['radioGroup']
-                           button_value = button_config.get('value')
-                           # If this specific group doesn't have a selection yet
-                           if group not in temp_selections_update or temp_selections_update.get(group) is None:
-                                # Select this button's value as the default for this group
-                                temp_selections_update[group] = button_value
-                                initial_selection_made = True # Flag that we modified state
-                                logger.debug(f"Pre-selecting radio option '{button_config.get('buttonName')}' for group '{group}' in step '{current_step_key}'.")
-
-
-            # If we made any initial selections during this generation, save the modified selections dict back to context
-            if initial_selection_made:
-                 workflow_state = self._get_workflow_state_from_context(context)
-                 workflow_state['selections'][current_step_key] = temp_selections_update
-                 # Update the local variable used for generating emojis with the latest state
-                 user_selections_for_step = temp_selections_update
-                 logger.debug(f"User: Saved pre-selected radio options for step '{current_step_key}'. Final state: {user_selections_for_step}")
-
-
-        # --- Build Option Buttons ---
-        for row_index, row in enumerate(step_config.get('options', [])):
+            # Fill in the precomputed per-group defaults for any group that has
+            # no selection yet. The defaults were derived from the step options
+            # once at init, so there is nothing left to scan per render.
+            for group, default_value in step_config.radio_defaults.items():
+                 if user_selections_for_step.get(group) is None:
+                      user_selections_for_step[group] = default_value
+                      logger.debug("Pre-selecting radio default '%s' for group '%s' in step '%s'.", default_value, group, current_step_key)
+
+
+        # --- Assemble the keyboard via the per-selection cache ---
+        # Users with the same selection state on a step see the same keyboard,
+        # so assembly is memoized on a canonicalized (hashable) selection key;
+        # repeat states become a dict hit instead of a rebuild.
+        if step_config.state_factory is dict:
+            selection_key = frozenset(user_selections_for_step.items())
+        else: # set (checkbox steps); dynamic steps always have a state factory
+            selection_key = frozenset(user_selections_for_step)
+        reply_markup = self._build_stateful_markup(current_step_key, selection_key)
+
+        # The step description was HTML-escaped at compile time
+        return reply_markup, step_config.escaped_description
+
+    def _build_markup_for_selection(self, step_key, selection_key):
+        """
+        Assembles the InlineKeyboardMarkup for a stateful step from a
+        canonicalized selection key (frozenset of dict items, or frozenset of
+        checkbox values). Only runs on cache misses — see the lru_cache
+        wrapper bound in __init__.
+        """
+        step_config = self._compiled_steps[step_key]
+        selections = dict(selection_key) if step_config.state_factory is dict else selection_key
+
+        # Buttons are prebuilt per label variant at init; rendering only picks
+        # the InlineKeyboardButton instance matching the selection state.
+        # Hoist the module-global type ids (and the selection lookup method)
+        # into locals: global/attribute loads are dict ops in CPython and this
+        # loop is the only remaining per-button work.
+        type_radio, type_checkbox, type_toggle = _TYPE_RADIO, _TYPE_CHECKBOX, _TYPE_TOGGLE
+        selections_get = selections.get if step_config.state_factory is dict else None
+        keyboard_rows = []
+        for row in step_config.button_rows:
             button_row = []
-            for button_index, button_config in enumerate(row):
-                button_text = button_config['buttonName']
-                button_value = button_config.get('value')
-                button_type = button_config.get('type') # Default is None
-
-                # Modify button text with emoji based on state and type
-                if button_type == 'radio':
-                    # For radio, check if the user's selection dictionary for this step has this group/value combination
-                    selected = False
-                    # Check if state is a dict and contains the group
-                    if isinstance(user_selections_for_step, dict) and 'radioGroup' in button_config:
-                         group = button_config['radioGroup']
-                         # Check if the value associated with the group in state matches this button's value
-                         if user_selections_for_step.get(group) == button_value:
-                             selected = True
-                    button_text = f"{RADIO_SELECTED} {button_text}" if selected else f"{RADIO_UNSELECTED} {button_text}"
-
-                elif button_type == 'checkbox':
-                    # For checkbox, check if the value is in the list of selections for the step
-                    selected = False
-                    # Check if state is a list
-                    if isinstance(user_selections_for_step, list) and button_value in user_selections_for_step:
-                        selected = True
-                    button_text = f"{CHECKBOX_SELECTED} {button_text}" if selected else f"{CHECKBOX_UNSELECTED} {button_text}"
-
-                elif button_type == 'toggle':
-                     # For toggle, check the boolean state associated with the value in the selections dict
-                     current_state = button_config.get('initialState', False) # Default state if not yet selected in state
-                     # Check if state is a dict
-                     if isinstance(user_selections_for_step, dict):
-                         # Get state from dict, fall back to button's initial state if not found in state
-                         current_state = user_selections_for_step.get(button_value, current_state)
-                     button_text = f"{TOGGLE_ON if current_state else TOGGLE_OFF} {button_text}"
-                # 'skip', 'finish' buttons and default buttons don't get state emojis here automatically
-                # (though 'finish' in JSON sample has emoji in buttonName)
-
-
-                # Callback data format: "step_key:row_index:button_index" for option buttons
-                callback_data = f"{current_step_key}:{row_index}:{button_index}"
-
-                button_row.append(InlineKeyboardButton(button_text, callback_data=callback_data))
+            for button in row:
+                type_id = button.type_id
+
+                if type_id == type_radio:
+                    # For radio, check if the selection dict has this group/value combination
+                    selected = (button.radio_group is not None
+                                and selections_get(button.radio_group) == button.value)
+                    ikb = button.ikb_selected if selected else button.ikb_unselected
+
+                elif type_id == type_checkbox:
+                    # For checkbox, check if the value is in the selection set for the step
+                    ikb = button.ikb_selected if button.value in selections else button.ikb_unselected
+
+                elif type_id == type_toggle:
+                     # For toggle, check the boolean state associated with the value in the selections dict,
+                     # falling back to the button's initial state if not yet flipped
+                     current_state = selections_get(button.value, button.initial_state)
+                     ikb = button.ikb_selected if current_state else button.ikb_unselected
+
+                else:
+                    # 'skip', 'finish' buttons and default buttons don't get state emojis
+                    # (though 'finish' in JSON sample has emoji in buttonName)
+                    ikb = button.ikb_plain
+
+                button_row.append(ikb)
             keyboard_rows.append(button_row)
 
-
         # --- Add Navigation/Completion Buttons ---
 
-        # Add 'Done/Next' button for manual completion steps
-        if step_completion_type == 'manual':
-            done_button_text = f"{DONE_EMOJI} Done / Next"
-            done_callback_data = f"done:{current_step_key}"
-            keyboard_rows.append([InlineKeyboardButton(done_button_text, callback_data=done_callback_data)])
+        # Add the prebuilt 'Done/Next' row for manual completion steps
+        if step_config.done_row is not None:
+            keyboard_rows.append(step_config.done_row)
 
-        # Add the 'Go Back' button IF configured for this step and a previous step exists
-        back_button_config = step_config.get('backButton')
-        if back_button_config:
-             if self._get_previous_step_key(current_step_key):
-                # Back button callback data format: "back:current_step_key"
-                back_callback_data = f"back:{current_step_key}"
-                keyboard_rows.append([InlineKeyboardButton(f"{BACK_EMOJI} Go Back", callback_data=back_callback_data)])
-             else:
-                 logger.debug(f"Step '{current_step_key}' has backButton config but is the first step. Not adding back button.")
+        # Add the prebuilt 'Go Back' row (None unless configured and a
+        # previous step exists — resolved at compile time)
+        if step_config.back_row is not None:
+            keyboard_rows.append(step_config.back_row)
 
+        # _CachedMarkup: the memoized markup's serialized payload is reused too
+        return _CachedMarkup(keyboard_rows)
 
-        reply_markup = InlineKeyboardMarkup(keyboard_rows)
 
-        # Escape the step description for MarkdownV2
-        description_text = step_config.get('description', 'Please make a selection:')
-        escaped_description = escape_markdown(description_text, version=2)
+    def render_selections_html(self, selections):
+        """
+        Renders a selections dict as escaped bullet lines in workflow step
+        order. Cheaper than a generic JSON pretty-print for the /selections
+        command, and the escaping is handled line-by-line via _esc.
 
-        return reply_markup, escaped_description
+        Args:
+            selections (dict): A selections mapping as returned by
+                get_user_selections.
 
+        Returns:
+            str: HTML-escaped text, one "- step: value" line per step.
+        """
+        return "\n".join(
+            _esc(f"- {step_key}: {_format_selection_value(selections[step_key])}")
+            for step_key in self._step_keys if step_key in selections
+        )
 
     def get_user_selections(self, context):
         """Retrieves the final selections made by a user from context."""
         workflow_state = self._get_workflow_state_from_context(context)
-        # Return a copy to prevent external modification of internal state
-        return workflow_state['selections'].copy()
+        # Return a copy to prevent external modification of internal state.
+        # Checkbox selections are kept as sets internally; convert them to
+        # sorted lists here so callers get stable, JSON-serializable values.
+        return {step_key: (sorted(value) if isinstance(value, set) else value)
+                for step_key, value in workflow_state.selections.items()}
 
     def reset_user_state(self, context):
         """Clears the state for a specific user in context."""
         # Ensure we only delete our specific workflow state key and check initialization
         if self.is_initialized and self.workflow_name in context.user_data:
             del context.user_data[self.workflow_name]
-            logger.info(f"User workflow state '{self.workflow_name}' in context.user_data reset.")
+            logger.info("User workflow state '%s' in context.user_data reset.", self.workflow_name)
         elif not self.is_initialized:
              logger.warning("Attempted to reset state but WorkflowManager not initialized.")
\ No newline at end of file
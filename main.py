@@ -1,16 +1,65 @@
 # main.py - Streamlined Interface
 
+import asyncio
+import html
 import logging
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler
 import inline_workflow_manager # Import our workflow module
 import json # For pretty printing user_data
-from telegram.helpers import escape_markdown # Import escaping utility
+
+# Prefer uvloop (libuv-backed event loop) when available: lower scheduling and
+# syscall overhead for the network-bound polling/edit path. PTB manages the
+# loop itself; installing the policy here is enough.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+
+def _json_default(obj):
+    """Serializes objects that expose to_dict() (e.g. WorkflowState) and the
+    manager's internal checkbox selection sets."""
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return obj.to_dict()
+
+# Prefer orjson (C-accelerated) for the per-click dumps of user data and
+# selections; fall back to the stdlib json module if it is not installed.
+try:
+    import orjson
+
+    def _jdump(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2, default=_json_default).decode()
+except ImportError:
+    def _jdump(obj):
+        return json.dumps(obj, indent=2, default=_json_default)
+
+
+class _LazyDump:
+    """
+    Defers _jdump until the log record is actually emitted, so disabling the
+    log level skips the serialization work entirely.
+    """
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return _jdump(self.obj)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Fixed user-facing strings, escaped for HTML parse mode once at import time
+# rather than on every command/callback.
+_ESC_START_ERR = html.escape("An unexpected error occurred starting the workflow.")
+_ESC_SELECTIONS_INTRO = html.escape("Your current selections:")
+_ESC_NO_SELECTIONS = html.escape("No selections made yet.")
+
 # --- Configuration ---
 # Replace with your actual bot token
 BOT_TOKEN = "Your Token" # !!! REMEMBER TO REPLACE THIS !!!
@@ -26,18 +75,18 @@ workflow_manager = inline_workflow_manager.InlineWorkflowManager(WORKFLOW_FILE)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Starts the workflow."""
     chat_id = update.effective_chat.id
-    logger.info(f"User {chat_id} started the workflow.")
+    logger.info("User %s started the workflow.", chat_id)
 
     # Call the manager's start method
     reply_markup, text = workflow_manager.start_workflow(context)
 
     if reply_markup is not None and text is not None: # Check if manager returned UI
-        await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+        await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode='HTML')
     elif text is not None: # Manager might return only error text on init failure
-         await context.bot.send_message(chat_id=chat_id, text=text, parse_mode='MarkdownV2')
+         await context.bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
     else:
          # Should ideally not happen if text is returned on init failure
-         await context.bot.send_message(chat_id=chat_id, text=escape_markdown("An unexpected error occurred starting the workflow.", version=2), parse_mode='MarkdownV2')
+         await context.bot.send_message(chat_id=chat_id, text=_ESC_START_ERR, parse_mode='HTML')
 
 
 async def show_selections(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -45,52 +94,92 @@ async def show_selections(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     chat_id = update.effective_chat.id
     selections = workflow_manager.get_user_selections(context)
 
-    # Log user data for debugging
-    logger.info(f"User {chat_id} context.user_data: {json.dumps(context.user_data, indent=2)}")
+    # Log user data for debugging (serialized lazily, and only if emitted)
+    logger.debug("User %s context.user_data: %s", chat_id, _LazyDump(context.user_data))
 
 
     if selections:
-        # Escape the introductory text, JSON dump should be fine in ```json block
-        intro_text = escape_markdown("Your current selections:", version=2)
-        selections_json_str = json.dumps(selections, indent=2)
-
-        text = f"{intro_text}\n```json\n{selections_json_str}\n```"
+        # Render as escaped bullet lines in step order; cheaper than a JSON
+        # pretty-print and avoids parse-mode escaping surprises.
+        text = f"{_ESC_SELECTIONS_INTRO}\n{workflow_manager.render_selections_html(selections)}"
     else:
-        text = escape_markdown("No selections made yet.", version=2)
+        text = _ESC_NO_SELECTIONS
 
-    # Send with MarkdownV2 parse mode
-    await context.bot.send_message(chat_id=chat_id, text=text, parse_mode='MarkdownV2')
+    # Send with HTML parse mode
+    await context.bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
 
 
 # --- Callback Query Handler ---
 
+def _message_unchanged(query, text, reply_markup):
+    """
+    Returns True when the message Telegram is already displaying matches the
+    new text and keyboard, so the edit_message_text round-trip (and its
+    'message is not modified' error) can be skipped entirely.
+    """
+    try:
+        message = query.message
+        if message is None:
+            return False
+        new_markup_json = reply_markup.to_json() if reply_markup else None
+        old_markup_json = message.reply_markup.to_json() if message.reply_markup else None
+        if new_markup_json != old_markup_json:
+            return False
+        return text == message.text_html
+    except Exception:
+        # When in doubt, edit — an occasional redundant edit is harmless.
+        return False
+
+
 async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles button clicks from the inline keyboard."""
     query = update.callback_query
-    # Always answer the query, regardless of processing outcome
-    await query.answer()
-
+    # Always answer the query, regardless of processing outcome. The ACK is an
+    # independent HTTP call, so fire it as a task and let it overlap with the
+    # state processing and edit_message_text below instead of paying its
+    # round-trip up front.
+    ack_task = asyncio.create_task(query.answer())
+    try:
+        await _process_button_click(update, context, query)
+    finally:
+        await ack_task
+
+
+async def _process_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE, query) -> None:
+    """The state-processing and message-edit portion of handle_button_click."""
     chat_id = query.message.chat.id
     callback_data = query.data
-    logger.info(f"User {chat_id} clicked button with data: {callback_data}")
+    logger.info("User %s clicked button with data: %s", chat_id, callback_data)
 
     # Call the manager's method to process the click and get the response UI/text
     response_text, reply_markup, is_final_message = workflow_manager.process_callback_and_get_response(context, callback_data)
 
-    # Log user data after processing callback
-    logger.info(f"User {chat_id} context.user_data AFTER callback: {json.dumps(context.user_data, indent=2)}")
+    # (None, None, False) means a stale/duplicate click: the displayed message is
+    # already correct, so there is nothing to edit.
+    if response_text is None and reply_markup is None and not is_final_message:
+        logger.debug("User %s: Stale callback ignored, no message edit needed.", chat_id)
+        return
+
+    # Log user data after processing callback (serialized lazily, and only if emitted)
+    logger.debug("User %s context.user_data AFTER callback: %s", chat_id, _LazyDump(context.user_data))
+
+    # Skip the edit when the click didn't change the visible message (e.g. a
+    # re-click on an already-selected radio option).
+    if _message_unchanged(query, response_text, reply_markup):
+        logger.debug("User %s: Message unchanged; skipping edit.", chat_id)
+        return
 
 
     # Based on the response from the manager, edit the message
     if is_final_message:
         # Workflow finished or encountered a critical error ending the workflow
         try:
-            await query.edit_message_text(text=response_text, reply_markup=reply_markup, parse_mode='MarkdownV2')
-            logger.info(f"User {chat_id}: Final/Error message edited.")
+            await query.edit_message_text(text=response_text, reply_markup=reply_markup, parse_mode='HTML')
+            logger.info("User %s: Final/Error message edited.", chat_id)
         except Exception as e:
-            logger.warning(f"User {chat_id}: Failed to edit message to show final/error state: {e}. Sending new message instead.")
+            logger.warning("User %s: Failed to edit message to show final/error state: %s. Sending new message instead.", chat_id, e)
             # Fallback: send a new message. Ensure parse_mode is correct.
-            await context.bot.send_message(chat_id=chat_id, text=response_text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+            await context.bot.send_message(chat_id=chat_id, text=response_text, reply_markup=reply_markup, parse_mode='HTML')
 
     else:
         # Workflow is ongoing (either moved to next step, stayed on current, or got validation error)
@@ -100,21 +189,21 @@ async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE
         if reply_markup is not None: # If there is a keyboard to show
              try:
                  # Edit the message to update the keyboard and text
-                 await query.edit_message_text(text=response_text, reply_markup=reply_markup, parse_mode='MarkdownV2')
-                 logger.debug(f"User {chat_id}: Edited message for next step.")
+                 await query.edit_message_text(text=response_text, reply_markup=reply_markup, parse_mode='HTML')
+                 logger.debug("User %s: Edited message for next step.", chat_id)
              except Exception as e:
-                 logger.warning(f"User {chat_id}: Failed to edit message for next step (might not be modified or too old): {e}.")
+                 logger.warning("User %s: Failed to edit message for next step (might not be modified or too old): %s.", chat_id, e)
                  # Optional fallback: send a new message.
-                 # await context.bot.send_message(chat_id=chat_id, text=response_text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+                 # await context.bot.send_message(chat_id=chat_id, text=response_text, reply_markup=reply_markup, parse_mode='HTML')
         else: # If no keyboard is returned (unlikely in this design unless a step has no buttons)
               try:
                  # Edit message text only, removing the keyboard if it was present
-                 await query.edit_message_text(text=response_text, reply_markup=None, parse_mode='MarkdownV2')
-                 logger.debug(f"User {chat_id}: Edited message text only.")
+                 await query.edit_message_text(text=response_text, reply_markup=None, parse_mode='HTML')
+                 logger.debug("User %s: Edited message text only.", chat_id)
               except Exception as e:
-                 logger.warning(f"User {chat_id}: Failed to edit message text only: {e}.")
+                 logger.warning("User %s: Failed to edit message text only: %s.", chat_id, e)
                  # Fallback: send a new message
-                 await context.bot.send_message(chat_id=chat_id, text=response_text, parse_mode='MarkdownV2')
+                 await context.bot.send_message(chat_id=chat_id, text=response_text, parse_mode='HTML')
 
 
 # --- Main Application Setup ---
@@ -126,7 +215,24 @@ def main():
         logger.error("Workflow manager failed to load data. Bot cannot start.")
         exit()
 
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Larger connection pools let concurrent callbacks reuse persistent HTTPS
+    # connections instead of queueing on the default (small) pool.
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(256)
+        .pool_timeout(10)
+        .get_updates_connection_pool_size(64)
+    )
+    # HTTP/2 multiplexes concurrent API calls over a single TLS connection,
+    # but requires the optional httpx[http2] extra; fall back to HTTP/1.1.
+    try:
+        import h2  # noqa: F401
+        builder = builder.http_version("2").get_updates_http_version("2")
+    except ImportError:
+        logger.info("httpx[http2] not installed; using HTTP/1.1.")
+
+    application = builder.build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))